@@ -82,6 +82,7 @@ app.include_router(public_router, prefix ='')
 if __name__ == '__main__':
 	import uvicorn
 	import argparse
+	import os
 
 	parser = argparse.ArgumentParser(description= 'API Administración de Planeación')
 
@@ -89,12 +90,20 @@ if __name__ == '__main__':
 	parser.add_argument('--port', type=int, help='Puerto de la API', default=8000)
 	parser.add_argument('--reload', action='store_true', help='Recargar la API al detectar cambios')
 
+	parser.add_argument('--ws_per_message_deflate', action=argparse.BooleanOptionalAction,
+						help='Comprimir mensajes websocket (permessage-deflate)',
+						default=config('WS_PER_MESSAGE_DEFLATE', default=True, cast=bool))
+
 	parser.add_argument('--ssl_keyfile', default=None)
 	parser.add_argument('--ssl_certfile', default=None)
 
 	args = parser.parse_args()
 
+	# The connection manager reads it to know which connections negotiated permessage-deflate
+	os.environ['WS_PER_MESSAGE_DEFLATE'] = str(args.ws_per_message_deflate)
+
 	# uvicorn api:app --reload --port $port --host $host
 	uvicorn.run('api:app', host=args.host, port=args.port, reload= args.reload, 
+				ws_per_message_deflate= args.ws_per_message_deflate,
 				ssl_keyfile= args.ssl_keyfile,
 				ssl_certfile= args.ssl_certfile)
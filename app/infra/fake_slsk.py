@@ -0,0 +1,183 @@
+import asyncio
+import os
+import tempfile
+import time
+
+from itertools import count
+
+from aioslsk.events import SearchResultEvent, EventBus
+from aioslsk.protocol.primitives import Attribute, FileData
+from aioslsk.search.model import SearchRequest, SearchResult
+from aioslsk.transfer.model import TransferState
+
+class FakeTransferState:
+    '''Holds the state enum in `VALUE`, like the aioslsk state objects.'''
+
+    def __init__(self, value: TransferState.State):
+        self.VALUE = value
+
+
+class FakeTransfer:
+    '''
+    Minimal stand-in for `aioslsk.transfer.model.Transfer`, only exposes what the
+    controller reads: `state`, `local_path` and `is_finalized()`.
+    '''
+
+    def __init__(self, username: str, remote_path: str, filesize: int):
+        self.username = username
+        self.remote_path = remote_path
+        self.filesize = filesize
+        self.bytes_transfered = 0
+
+        self.state = FakeTransferState(TransferState.QUEUED)
+        self.local_path: str|None = None
+
+    def is_finalized(self) -> bool:
+        return self.state.VALUE in (
+            TransferState.COMPLETE,
+            TransferState.ABORTED,
+            TransferState.FAILED
+        )
+
+
+class FakeSearchManager:
+    def __init__(self, client: 'FakeSoulSeekClient'):
+        self._client = client
+        self._tickets = count(1)
+
+        self.requests: dict[int, SearchRequest] = {}
+
+    def remove_request(self, request: SearchRequest|int):
+        ticket = request if isinstance(request, int) else request.ticket
+        self.requests.pop(ticket)
+
+    async def search(self, query: str) -> SearchRequest:
+        request = SearchRequest(ticket= next(self._tickets), query= query)
+
+        self.requests[request.ticket] = request
+        self._client._spawn(self._client._emit_search_results(request))
+
+        return request
+
+
+class FakeTransferManager:
+    def __init__(self, client: 'FakeSoulSeekClient'):
+        self._client = client
+
+    async def download(self, username: str, filename: str, paused: bool = False) -> FakeTransfer:
+        transfer = FakeTransfer(username, filename, self._client.transfer_size)
+
+        self._client._spawn(self._client._simulate_transfer(transfer))
+
+        return transfer
+
+
+class FakeSoulSeekClient:
+    '''
+    Pluggable replacement for `SoulSeekClient` that never touches the network.
+
+    Every search emits `peers` synthetic `SearchResultEvent`s of `files_per_peer`
+    files each, at `results_per_second`. The emission time in nanoseconds is
+    embedded in each remote filename between brackets (`... [<time_ns>].flac`)
+    so benchmark clients can measure result delivery latency.
+
+    Downloads write `transfer_size` bytes to a temporary directory over
+    `transfer_seconds` and then complete. Logging in takes `login_seconds`.
+    '''
+
+    def __init__(self,
+                 peers: int = 20,
+                 files_per_peer: int = 10,
+                 results_per_second: float = 50,
+                 transfer_seconds: float = 2,
+                 transfer_size: int = 1024 * 1024,
+                 login_seconds: float = 0,
+                 event_bus: EventBus|None = None):
+        self.peers = peers
+        self.files_per_peer = files_per_peer
+        self.results_per_second = results_per_second
+        self.transfer_seconds = transfer_seconds
+        self.transfer_size = transfer_size
+        self.login_seconds = login_seconds
+
+        self.events = event_bus or EventBus()
+        self.searches = FakeSearchManager(self)
+        self.transfers = FakeTransferManager(self)
+
+        self._tasks: set[asyncio.Task] = set()
+        self._download_dir = tempfile.mkdtemp(prefix='fake_slsk_')
+
+    async def start(self):
+        pass
+
+    async def login(self):
+        await asyncio.sleep(self.login_seconds)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _file_data(self, request: SearchRequest, peer: int, n: int) -> FileData:
+        filename = f"@@fake\\peer{peer:04d}\\{request.query} - {n:02d} [{time.time_ns()}].flac"
+
+        return FileData(
+            unknown= 1,
+            filename= filename,
+            filesize= self.transfer_size,
+            extension= '',
+            attributes= [
+                Attribute(0, 1411),
+                Attribute(1, 180 + n),
+                Attribute(4, 44100),
+                Attribute(5, 16)
+            ]
+        )
+
+    async def _emit_search_results(self, request: SearchRequest):
+        delay = 1 / self.results_per_second if self.results_per_second > 0 else 0
+
+        for peer in range(self.peers):
+            await asyncio.sleep(delay)
+
+            # Removed requests stop producing results, like aioslsk ignores them
+            if request.ticket not in self.searches.requests:
+                return
+
+            result = SearchResult(
+                ticket= request.ticket,
+                username= f"peer{peer:04d}",
+                has_free_slots= True,
+                shared_items= [ self._file_data(request, peer, n) for n in range(self.files_per_peer) ]
+            )
+
+            request.results.append(result)
+
+            await self.events.emit(SearchResultEvent(query= request, result= result))
+
+    async def _simulate_transfer(self, transfer: FakeTransfer):
+        steps = 10
+        chunk = b'\0' * (transfer.filesize // steps)
+
+        transfer.state = FakeTransferState(TransferState.DOWNLOADING)
+
+        fd, local_path = tempfile.mkstemp(suffix='.flac', dir=self._download_dir)
+
+        with os.fdopen(fd, 'wb') as f:
+            for n in range(steps):
+                await asyncio.sleep(self.transfer_seconds / steps)
+
+                if n == steps - 1:
+                    chunk = b'\0' * (transfer.filesize - transfer.bytes_transfered)
+
+                f.write(chunk)
+                transfer.bytes_transfered += len(chunk)
+
+        transfer.local_path = local_path
+        transfer.state = FakeTransferState(TransferState.COMPLETE)
@@ -0,0 +1,88 @@
+import asyncio
+
+from typing import AsyncIterator
+
+class AsyncFileReader:
+    '''
+    Reads files without blocking the event loop.
+
+    Blocking reads run in the default thread pool, one chunk per call, so a large
+    file never holds a worker thread for long. At most `concurrency` reads run at
+    the same time and up to `read_ahead` chunks are prefetched while the
+    consumer handles the current one.
+
+    Example of usage:
+    ```python
+    reader = AsyncFileReader()
+
+    html = await reader.read_text('public/front/index.html')
+
+    async for chunk in reader.iter_chunks(path):
+        await websocket.send_bytes(chunk)
+    ```
+    '''
+
+    def __init__(self, concurrency: int = 4, chunk_size: int = 1024 * 1024, read_ahead: int = 2):
+        self.chunk_size = chunk_size
+        self.read_ahead = read_ahead
+
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def _run(self, func, *args):
+        async with self._semaphore:
+            return await asyncio.to_thread(func, *args)
+
+    async def iter_chunks(self, path: str) -> AsyncIterator[bytes]:
+        f = await self._run(open, path, 'rb')
+
+        try:
+            queue: asyncio.Queue[bytes] = asyncio.Queue(maxsize=max(self.read_ahead, 1))
+
+            async def producer():
+                while True:
+                    chunk = await self._run(f.read, self.chunk_size)
+                    await queue.put(chunk)
+
+                    if not chunk:
+                        return
+
+            task = asyncio.create_task(producer())
+
+            try:
+                while True:
+                    # Surface read errors instead of waiting forever on the queue
+                    getter = asyncio.ensure_future(queue.get())
+                    await asyncio.wait((getter, task), return_when=asyncio.FIRST_COMPLETED)
+
+                    if not getter.done() and task.exception():
+                        getter.cancel()
+                        task.result()
+
+                    chunk = await getter
+
+                    if not chunk:
+                        return
+
+                    yield chunk
+
+            finally:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+
+        finally:
+            await asyncio.to_thread(f.close)
+
+    async def read_bytes(self, path: str) -> bytes:
+        '''
+        Reads the whole file in memory, meant for small files. Large files should
+        be consumed with `iter_chunks`, joining them blocks the event loop.
+        '''
+        buffer = bytearray()
+
+        async for chunk in self.iter_chunks(path):
+            buffer += chunk
+
+        return bytes(buffer)
+
+    async def read_text(self, path: str, encoding: str = 'utf-8') -> str:
+        return (await self.read_bytes(path)).decode(encoding)
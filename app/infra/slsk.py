@@ -1,13 +1,15 @@
 import asyncio
 import sys
 
-from typing import Callable
+from typing import TYPE_CHECKING, Callable
 
-from aioslsk.client import SoulSeekClient
-from aioslsk.settings import Settings, CredentialsSettings
-from aioslsk.search.model import SearchRequest
-from aioslsk.transfer.model import Transfer
-from aioslsk.events import SearchResultEvent, EventBus, SessionDestroyedEvent
+# aioslsk takes about half of the startup time, it is imported once a client is created
+if TYPE_CHECKING:
+    from aioslsk.client import SoulSeekClient
+    from aioslsk.settings import Settings
+    from aioslsk.search.model import SearchRequest
+    from aioslsk.transfer.model import Transfer
+    from aioslsk.events import SearchResultEvent, EventBus, SessionDestroyedEvent
 
 class SoulseekAccesor:
     '''
@@ -18,14 +20,16 @@ class SoulseekAccesor:
     ```
     '''
 
-    _client: SoulSeekClient
-    _settings: Settings
+    _client: 'SoulSeekClient'
+    _settings: 'Settings'
+
+    def __init__(self, settings: 'Settings'):
+        from aioslsk.client import SoulSeekClient
 
-    def __init__(self, settings: Settings):
         self._settings = settings
         self._client = SoulSeekClient(self._settings)
 
-    async def __aenter__(self) -> SoulSeekClient:
+    async def __aenter__(self) -> 'SoulSeekClient':
         await self._client.start()
         await self._client.login()
         return self._client
@@ -36,10 +40,13 @@ class SoulseekAccesor:
 
 async def get_slsk_client(username:str,
                           password:str, 
-                          bus: EventBus|None = None) -> SoulSeekClient:
+                          bus: 'EventBus|None' = None) -> 'SoulSeekClient':
     '''
     Returns a non-initialized SoulSeekClient instance
     '''
+    from aioslsk.client import SoulSeekClient
+    from aioslsk.settings import Settings, CredentialsSettings
+
     if sys.platform == 'win32':
         asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
 
@@ -58,17 +65,31 @@ async def get_slsk_client(username:str,
     return client
 
 
-def register_session_destroyed_event(client: SoulSeekClient, callback: Callable[[SessionDestroyedEvent], None]):
+def register_session_destroyed_event(client: 'SoulSeekClient', callback: Callable[['SessionDestroyedEvent'], None]):
+    from aioslsk.events import SessionDestroyedEvent
+
     client.events.register(SessionDestroyedEvent, callback)
 
 
-def register_search_result_event(client: SoulSeekClient, callback: Callable[[SearchResultEvent], None]):
+def register_search_result_event(client: 'SoulSeekClient', callback: Callable[['SearchResultEvent'], None]):
+    from aioslsk.events import SearchResultEvent
+
     client.events.register(SearchResultEvent, callback)
 
 
-async def slsk_search_request(client: SoulSeekClient, query: str) -> SearchRequest:
+async def slsk_search_request(client: 'SoulSeekClient', query: str) -> 'SearchRequest':
     return await client.searches.search(query)
 
 
-async def slsk_start_track_transfer(client: SoulSeekClient, ticket: int, username: str, filename: str) -> Transfer:
-    return await client.transfers.download(ticket, username, filename)
\ No newline at end of file
+def slsk_remove_search_request(client: 'SoulSeekClient', ticket: int):
+    '''
+    Stops collecting results for the ticket, results arriving afterwards are ignored by the client
+    '''
+    try:
+        client.searches.remove_request(ticket)
+    except KeyError:
+        pass
+
+
+async def slsk_start_track_transfer(client: 'SoulSeekClient', username: str, filename: str) -> 'Transfer':
+    return await client.transfers.download(username, filename)
\ No newline at end of file
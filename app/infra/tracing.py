@@ -0,0 +1,158 @@
+'''
+Span instrumentation with the shape of the OpenTelemetry tracing API
+(`start_span`, `start_as_current_span`, `set_attribute`, `add_event`, `end`).
+
+Tracing is a no-op until `configure_tracing` is called with an exporter:
+  - "console": one JSON line per finished span on stderr
+  - "file": one JSON line per finished span appended to a file
+  - "otel": the tracer of the `opentelemetry-api` package, if installed
+
+Example of usage:
+```python
+with get_tracer().start_as_current_span('work', attributes={'ticket': 1}) as span:
+    span.add_event('halfway')
+```
+'''
+
+import json
+import os
+import sys
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator, TextIO
+
+class Span:
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+    def add_event(self, name: str, attributes: dict|None = None):
+        pass
+
+    def end(self):
+        pass
+
+    def is_recording(self) -> bool:
+        return False
+
+
+class Tracer:
+    def start_span(self, name: str, attributes: dict|None = None) -> Span:
+        return _NOOP_SPAN
+
+    @contextmanager
+    def start_as_current_span(self, name: str, attributes: dict|None = None) -> Iterator[Span]:
+        yield _NOOP_SPAN
+
+
+_NOOP_SPAN = Span()
+
+# region Local exporter
+
+_current_span: ContextVar['LocalSpan|None'] = ContextVar('current_span', default=None)
+
+
+class LocalSpan(Span):
+    def __init__(self, tracer: 'LocalTracer', name: str, parent: 'LocalSpan|None', attributes: dict|None = None):
+        self._tracer = tracer
+        self._ended = False
+
+        self.name = name
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+
+        self.start_ns = time.time_ns()
+        self.end_ns: int|None = None
+
+        self.attributes = dict(attributes or {})
+        self.events: list[dict] = []
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def add_event(self, name: str, attributes: dict|None = None):
+        self.events.append({ 'name': name, 'time_ns': time.time_ns(), 'attributes': attributes or {} })
+
+    def end(self):
+        if self._ended:
+            return
+
+        self._ended = True
+        self.end_ns = time.time_ns()
+        self._tracer.export(self)
+
+    def is_recording(self) -> bool:
+        return not self._ended
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_ns': self.start_ns,
+            'end_ns': self.end_ns,
+            'duration_ms': (self.end_ns - self.start_ns) / 1e6,
+            'attributes': self.attributes,
+            'events': self.events,
+        }
+
+
+class LocalTracer(Tracer):
+    '''
+    Writes finished spans as JSON lines to `out`, straight from the event loop
+    since lines are small.
+    '''
+
+    def __init__(self, out: TextIO):
+        self._out = out
+
+    def export(self, span: LocalSpan):
+        self._out.write(json.dumps(span.to_dict(), default=str) + '\n')
+
+    def start_span(self, name: str, attributes: dict|None = None) -> Span:
+        return LocalSpan(self, name, _current_span.get(), attributes)
+
+    @contextmanager
+    def start_as_current_span(self, name: str, attributes: dict|None = None) -> Iterator[Span]:
+        span = self.start_span(name, attributes)
+        token = _current_span.set(span)
+
+        try:
+            yield span
+
+        except BaseException as e:
+            span.set_attribute('error', repr(e))
+            raise
+
+        finally:
+            _current_span.reset(token)
+            span.end()
+
+# endregion
+
+_tracer: Tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+    return _tracer
+
+
+def configure_tracing(exporter: str = 'none', path: str = 'traces.jsonl'):
+    global _tracer
+
+    if exporter == 'console':
+        _tracer = LocalTracer(sys.stderr)
+
+    elif exporter == 'file':
+        _tracer = LocalTracer(open(path, 'a', buffering=1))
+
+    elif exporter == 'otel':
+        from opentelemetry import trace
+
+        _tracer = trace.get_tracer('py_soulseek_webhook_srv')
+
+    else:
+        _tracer = Tracer()
@@ -1,15 +1,125 @@
-from typing import Callable
+import zlib
+
+from asyncio import gather
+from time import monotonic
+from typing import Callable, Iterable
 from asyncio import iscoroutinefunction
 from starlette.websockets import WebSocket
 
 # https://fastapi.tiangolo.com/advanced/websockets/#handling-disconnections-and-multiple-clients
 
+class PayloadMetrics:
+    """
+    Counters of outgoing text payload sizes.
+
+    When `estimate_deflate` is enabled, the deflated size of the messages sent on
+    connections that negotiated permessage-deflate is estimated with a raw deflate
+    stream per connection (same framing as permessage-deflate with context takeover).
+    It is an estimate: the real compressor parameters may differ, and it doubles
+    the deflate work on the event loop, so it is meant for benchmarks only.
+    """
+
+    def __init__(self, estimate_deflate: bool = False):
+        self.estimate_deflate = estimate_deflate
+
+        self.messages = 0
+        self.bytes_raw = 0
+
+        self.bytes_raw_deflate = 0
+        '''Raw bytes sent on connections that negotiated permessage-deflate.'''
+
+        self.bytes_deflated_estimate = 0
+
+        self._compressors: dict[str, 'zlib._Compress'] = {}
+
+    def track_deflate(self, client_id: str):
+        '''
+        Starts estimating the deflated size of the messages of a connection that negotiated permessage-deflate.
+        '''
+        if self.estimate_deflate:
+            self._compressors[client_id] = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+
+    def record(self, client_id: str, message: str, size: int):
+        '''
+        Counts a message of `size` encoded bytes, the message is only encoded again to estimate its deflated size.
+        '''
+        self.messages += 1
+        self.bytes_raw += size
+
+        c = self._compressors.get(client_id)
+
+        if c is None:
+            return
+
+        self.bytes_raw_deflate += size
+
+        # permessage-deflate strips the trailing 0x00 0x00 0xff 0xff of the sync flush
+        self.bytes_deflated_estimate += len(c.compress(message.encode()) + c.flush(zlib.Z_SYNC_FLUSH)) - 4
+
+    def forget(self, client_id: str):
+        self._compressors.pop(client_id, None)
+
+    @property
+    def compression_ratio_estimate(self) -> float|None:
+        if not self.estimate_deflate or not self.bytes_raw_deflate:
+            return None
+
+        return self.bytes_deflated_estimate / self.bytes_raw_deflate
+
+    def as_dict(self) -> dict:
+        return {
+            'messages': self.messages,
+            'bytes_raw': self.bytes_raw,
+            'bytes_raw_deflate': self.bytes_raw_deflate if self.estimate_deflate else None,
+            'bytes_deflated_estimate': self.bytes_deflated_estimate if self.estimate_deflate else None,
+            'compression_ratio_estimate': self.compression_ratio_estimate,
+        }
+
+
+class TokenBucket:
+    """
+    Inbound rate limiter: allows bursts of `burst` messages, refilled at `rate` messages per second.
+    A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+
+        self._tokens = float(burst)
+        self._updated = monotonic()
+
+    def consume(self) -> bool:
+        if not self.rate:
+            return True
+
+        now = monotonic()
+
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+        if self._tokens < 1:
+            return False
+
+        self._tokens -= 1
+        return True
+
+
 class ConnectionManager:
-    def __init__(self):
+    def __init__(self, max_payload_size: int = 0, metrics: PayloadMetrics|None = None, per_message_deflate: bool = False):
         self.active_connections: dict[str, WebSocket] = {}
+
+        self.per_message_deflate = per_message_deflate
+        '''Whether the server accepts permessage-deflate, it is negotiated with the clients that offer it.'''
+
+        self.max_payload_size = max_payload_size
+        '''Size budget in bytes for a single text message, 0 means unlimited. Enforced by the callers that know how to split their payloads.'''
+
+        self.metrics = metrics or PayloadMetrics()
         
         self._event_handlers : dict[str, list[Callable]] = {
-            'connection': []
+            'connection': [],
+            'disconnection': []
         }
 
     async def _emit_events(self, event:str, *args, **kwargs):
@@ -24,7 +134,7 @@ class ConnectionManager:
 
             except Exception:
                 print(
-                    "exception notifying listener %r of event %r" % listener, event
+                    "exception notifying listener %r of event %r" % (listener, event)
                 )
 
     async def register_connection_event_listener(self, listener: Callable[ [str, WebSocket], None ]):
@@ -32,28 +142,87 @@ class ConnectionManager:
 
         self._event_handlers['connection'].append(listener)
 
+    async def register_disconnection_event_listener(self, listener: Callable[ [str], None ]):
+        self._event_handlers.setdefault('disconnection', [])
+
+        self._event_handlers['disconnection'].append(listener)
+
     async def connect(self, client_id:str, websocket: WebSocket):
         await websocket.accept()
         self.active_connections[client_id] = websocket
 
+        if self.per_message_deflate and 'permessage-deflate' in websocket.headers.get('sec-websocket-extensions', ''):
+            self.metrics.track_deflate(client_id)
+
         await self._emit_events('connection', client_id, websocket)
 
     async def disconnect(self, client_id:str):
         websocket = self.active_connections.pop(client_id, None)
+        self.metrics.forget(client_id)
         if websocket:
-            await websocket.close()
+            await self._emit_events('disconnection', client_id)
 
-    async def send_personal_message(self, message: str, client_id: str):
+            # Already closed by the client or after a failed send
+            try:
+                await websocket.close()
+            except Exception:
+                pass
+
+    async def send_personal_message(self, message: str, client_id: str, size: int|None = None):
         websocket = self.active_connections.get(client_id)
         if websocket:
+            self.metrics.record(client_id, message, len(message.encode()) if size is None else size)
             await websocket.send_text(message)
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections.values():
+    @staticmethod
+    async def _send_text(connection: WebSocket, message: str) -> Exception|None:
+        try:
             await connection.send_text(message)
+        except Exception as e:
+            return e
+
+    async def send_many(self, message: str, client_ids: Iterable[str], size: int|None = None):
+        '''
+        Sends the message to the connected clients of `client_ids` concurrently. A failed send does
+        not affect the other clients, the failing connections are dropped.
+        `size` is the encoded size of the message when the caller already knows it.
+        '''
+        if size is None:
+            size = len(message.encode())
+
+        connections = [
+            (client_id, self.active_connections[client_id])
+            for client_id in client_ids
+            if client_id in self.active_connections
+        ]
+
+        for client_id, _ in connections:
+            self.metrics.record(client_id, message, size)
+
+        if len(connections) == 1:
+            # gather wraps each send in a task queued behind the whole loop, the usual single recipient is sent inline
+            results = [ await self._send_text(connections[0][1], message) ]
+        else:
+            results = await gather(
+                *( self._send_text(connection, message) for _, connection in connections )
+            )
+
+        for (client_id, _), result in zip(connections, results):
+            if isinstance(result, Exception):
+                await self.disconnect(client_id)
+
+    async def broadcast(self, message: str):
+        await self.send_many(message, list(self.active_connections))
 
-    async def disconnect_all(self):
-        for connection in self.active_connections.values():
-            await connection.close()
+    async def disconnect_all(self, code: int = 1000, reason: str|None = None):
+        '''
+        Closes every connection concurrently. Code 1012 (service restart) tells clients to reconnect.
+        '''
+        connections = list(self.active_connections.values())
+        self.active_connections.clear()
 
-        self.active_connections.clear()
\ No newline at end of file
+        # Sockets already closed by the client or the server raise, they are closed either way
+        await gather(
+            *( connection.close(code=code, reason=reason) for connection in connections ),
+            return_exceptions=True
+        )
\ No newline at end of file
@@ -1,145 +1,518 @@
 from contextlib import asynccontextmanager
 from decouple import config
-from fastapi import FastAPI, APIRouter, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, APIRouter, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, JSONResponse
 
 import asyncio
+import hmac
+import json
+import os
+
+from typing import TYPE_CHECKING, Awaitable, Callable
 
 from app.infra.slsk import (
-	SoulSeekClient,
-	SearchResultEvent,
-	SessionDestroyedEvent,
 	get_slsk_client,
 	register_search_result_event,
 	register_session_destroyed_event,
 	slsk_start_track_transfer
   )
 
-from app.infra.websockets import ConnectionManager
+from app.infra.files import AsyncFileReader
+from app.infra.tracing import configure_tracing, get_tracer
+from app.infra.websockets import ConnectionManager, PayloadMetrics, TokenBucket
 
 from .models import (
 	WebsocketClientMessage, WebsocketServerMessage,
-	WebsocketClientMessageType, WebsocketServerMessageType
+	WebsocketClientMessageType, WebsocketServerMessageType,
+	SearchRequestMessage, TrackDownloadRequestMessage,
+	TrackDownloadStatus, TrackInfo, ServerReadiness
 	)
 
+from .track_prefetch import TrackPrefetcher
 from .track_search_manager import TrackSearchSessionManager
 
+if TYPE_CHECKING:
+	from app.infra.slsk import SoulSeekClient, SearchResultEvent, SessionDestroyedEvent
+
 public_router = APIRouter()
 
-slsk : SoulSeekClient = None
+slsk : 'SoulSeekClient' = None
 manager : ConnectionManager = None
 track_search_manager : TrackSearchSessionManager = None
+file_reader : AsyncFileReader = None
+track_prefetcher : TrackPrefetcher|None = None
+
+readiness : ServerReadiness = ServerReadiness.STARTING
+login_task : asyncio.Task|None = None
+drain_task : asyncio.Task|None = None
+
+FRONT_DIR = os.path.join('public', 'front')
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-	global slsk, manager, track_search_manager
+	global manager, file_reader, login_task
 
-	slsk = await get_slsk_client(
-		username= config('SLSK_USERNAME'),
-		password= config('SLSK_PASSWORD')
+	configure_tracing(
+		exporter= config('TRACING_EXPORTER', default='none'),
+		path= config('TRACING_FILE', default='traces.jsonl')
 	)
 
+	file_reader = AsyncFileReader(
+		concurrency= config('FILE_IO_CONCURRENCY', default=4, cast=int),
+		chunk_size= config('FILE_IO_CHUNK_SIZE', default=1024 * 1024, cast=int),
+		read_ahead= config('FILE_IO_READ_AHEAD', default=2, cast=int)
+	)
+
+	manager = ConnectionManager(
+		max_payload_size= config('WS_MAX_PAYLOAD_SIZE', default=64 * 1024, cast=int),
+		metrics= PayloadMetrics(
+			estimate_deflate= config('WS_COMPRESSION_METRICS', default=False, cast=bool)
+			),
+		per_message_deflate= config('WS_PER_MESSAGE_DEFLATE', default=True, cast=bool)
+	)
+
+	async def on_new_connection(_, ws: WebSocket):
+		msg = WebsocketServerMessage.from_ws_server_message_enum().model_dump_json()
+		await ws.send_text(msg)
+
+		msg = WebsocketServerMessage.from_readiness(readiness).model_dump_json()
+		await ws.send_text(msg)
+
+	await manager.register_connection_event_listener(on_new_connection)
+
+	async def on_disconnection(client_id: str):
+		if track_search_manager:
+			await track_search_manager.unsubscribe(client_id)
+
+	await manager.register_disconnection_event_listener(on_disconnection)
+
+	if config('SLSK_DEFERRED_LOGIN', default=False, cast=bool):
+		# Serve right away, readiness is reported to clients and on /health while logging in
+		login_task = asyncio.create_task(setup_slsk(retry= True))
+	else:
+		await setup_slsk(retry= False)
+
+	yield
+
+	if login_task and not login_task.done():
+		login_task.cancel()
+
+	# uvicorn closes the websockets before this point, /admin/drain should be called first on deploys
+	await start_drain()
+
+	if slsk:
+		await slsk.stop()
+
+
+async def set_readiness(state: ServerReadiness):
+	global readiness
+
+	# Draining is final
+	if readiness == ServerReadiness.DRAINING:
+		return
+
+	readiness = state
+
+	# /health reports it either way, a failed notification must not abort the drain or the login
+	try:
+		await manager.broadcast(WebsocketServerMessage.from_readiness(state).model_dump_json())
+	except Exception as e:
+		print(f"Could not notify readiness {state.name}: {e}")
+
+
+async def on_search_result(result: 'SearchResultEvent'):
+	await track_search_manager.on_search_result_event(result)
+
+
+async def reconnect_session(e: 'SessionDestroyedEvent'):
 	await slsk.start()
 	await slsk.login()
 
-	manager = ConnectionManager()
 
-	track_search_manager = TrackSearchSessionManager(manager, slsk)
-
-	async def on_search_result(result: SearchResultEvent):
-		await track_search_manager.on_search_result_event(result)
+async def create_slsk():
+	'''
+	Creates the Soulseek client and the managers depending on it, registering the event listeners.
+
+	The event listeners are module functions: aioslsk only keeps weak references to them.
+	'''
+	global slsk, track_search_manager, track_prefetcher
+
+	if config('SLSK_BACKEND', default='aioslsk') == 'fake':
+		# Synthetic backend for load tests, see loadtest.py
+		from app.infra.fake_slsk import FakeSoulSeekClient
+
+		slsk = FakeSoulSeekClient(
+			peers= config('FAKE_SLSK_PEERS', default=20, cast=int),
+			files_per_peer= config('FAKE_SLSK_FILES_PER_PEER', default=10, cast=int),
+			results_per_second= config('FAKE_SLSK_RESULTS_PER_SECOND', default=50, cast=float),
+			transfer_seconds= config('FAKE_SLSK_TRANSFER_SECONDS', default=2, cast=float),
+			login_seconds= config('FAKE_SLSK_LOGIN_SECONDS', default=0, cast=float)
+		)
+
+	else:
+		slsk = await get_slsk_client(
+			username= config('SLSK_USERNAME'),
+			password= config('SLSK_PASSWORD')
+		)
+
+	if config('PREFETCH_ENABLED', default=False, cast=bool):
+		track_prefetcher = TrackPrefetcher(
+			slsk,
+			top_n= config('PREFETCH_TOP_N', default=3, cast=int),
+			disk_budget= config('PREFETCH_DISK_BUDGET', default=2 * 1024 ** 3, cast=int),
+			max_transfers= config('PREFETCH_MAX_TRANSFERS', default=2, cast=int)
+		)
+
+	track_search_manager = TrackSearchSessionManager(
+		manager, slsk,
+		max_results= config('SEARCH_MAX_RESULTS', default=2000, cast=int),
+		max_age= config('SEARCH_MAX_AGE', default=300, cast=float),
+		prefetcher= track_prefetcher,
+		stable_after= config('SEARCH_STABLE_AFTER', default=5, cast=float)
+	)
 
 	register_search_result_event(slsk, on_search_result)
 
 	# register_session_destroyed_event(slsk, lambda e: asyncio.create_task(app.state.lifespan.shutdown()))
 
-	async def reconnect_session(e: SessionDestroyedEvent):
-		await slsk.start()
-		await slsk.login()
-
 	register_session_destroyed_event(slsk, reconnect_session)
 
-	async def on_new_connection(_, ws: WebSocket):
-		msg = WebsocketServerMessage.from_ws_server_message_enum().model_dump_json()
-		await ws.send_text(msg)
 
-	manager.register_connection_event_listener(on_new_connection)
+async def setup_slsk(retry: bool):
+	'''
+	Creates the Soulseek client, then logs in. With `retry`, failed logins are retried with an
+	exponential backoff instead of raising, and configuration errors are reported as FAILED.
+	'''
+	try:
+		await create_slsk()
 
-	yield
+	except Exception as e:
+		if not retry:
+			raise
 
-	await asyncio.gather(
-		slsk.stop(),
-		manager.disconnect_all()
-	)
+		# Runs as a background task, nobody would retrieve the exception
+		print(f"Soulseek client setup failed: {e!r}")
+
+		await set_readiness(ServerReadiness.FAILED)
+		return
+
+	delay = 5
+
+	while True:
+		try:
+			await slsk.start()
+			await slsk.login()
+			break
+
+		except Exception as e:
+			if not retry:
+				raise
+
+			print(f"Soulseek login failed, retrying in {delay}s: {e}")
+
+			await set_readiness(ServerReadiness.FAILED)
+
+			try:
+				await slsk.stop()
+			except Exception:
+				pass
+
+			await asyncio.sleep(delay)
+
+			delay = min(delay * 2, 300)
+
+	await set_readiness(ServerReadiness.READY)
+
+	await resume_from_snapshot()
+
+
+async def save_snapshot(searches: list[dict]):
+	unfinished = [
+		{ 'client_id': client_id, 'username': track.username, 'filename': track.fullpath, 'track': track.model_dump(mode='json') }
+		for task, (client_id, track) in active_downloads.items()
+		if not task.done()
+	]
+
+	snapshot = {
+		'searches': searches,
+		'downloads': unfinished
+	}
+
+	def write():
+		with open(config('DRAIN_SNAPSHOT_FILE', default='drain_snapshot.json'), 'w') as f:
+			json.dump(snapshot, f)
+
+	await asyncio.to_thread(write)
+
+
+async def resume_from_snapshot():
+	'''
+	Restarts the searches and downloads left unfinished by the previous instance. Clients that
+	reconnect and search again subscribe to the restarted search. aioslsk returns the existing
+	transfer when the same file is requested again, so clients that ask for it again pick it up.
+	'''
+	path = config('DRAIN_SNAPSHOT_FILE', default='drain_snapshot.json')
+
+	if not os.path.exists(path):
+		return
+
+	snapshot = json.loads(await file_reader.read_text(path))
+
+	for search in snapshot.get('searches', []):
+		if search['state'] != 'ACTIVE':
+			continue
+
+		try:
+			await track_search_manager.resume_search(search['query'], grace= config('DRAIN_RESUME_GRACE', default=60, cast=float))
+		except Exception as e:
+			print(f"Could not resume search of {search['query']}: {e}")
+
+	for d in snapshot.get('downloads', []):
+		try:
+			await slsk_start_track_transfer(slsk, d['username'], d['filename'])
+		except Exception as e:
+			print(f"Could not resume download of {d['filename']} from {d['username']}: {e}")
+
+	await asyncio.to_thread(os.remove, path)
+
+
+async def drain(timeout: float):
+	await set_readiness(ServerReadiness.DRAINING)
+
+	# Taken before closing, closed searches are forgotten
+	searches = track_search_manager.snapshot() if track_search_manager else []
+
+	# No more results are accepted, the ones received were already delivered inline
+	if track_search_manager:
+		track_search_manager.close_all()
+
+	if active_downloads:
+		await asyncio.wait(list(active_downloads), timeout=timeout)
+
+	await save_snapshot(searches)
+
+	for task in list(active_downloads):
+		task.cancel()
+
+	await manager.disconnect_all(code=1012, reason="Server restarting, reconnect")
+
+
+def start_drain() -> asyncio.Task:
+	'''
+	Starts draining the server once, later calls return the same task.
+	'''
+	global drain_task
+
+	if not drain_task:
+		drain_task = asyncio.create_task(drain(config('DRAIN_TIMEOUT', default=60, cast=float)))
+
+	return drain_task
+
+
+@public_router.post("/admin/drain")
+async def endpoint_drain(request: Request):
+	# A loopback check is not enough: behind a reverse proxy every request comes from 127.0.0.1
+	token = config('ADMIN_TOKEN', default='')
+
+	if not token:
+		return JSONResponse(content={'detail': 'Admin endpoints disabled, set ADMIN_TOKEN'}, status_code=403)
+
+	scheme, _, credentials = request.headers.get('authorization', '').partition(' ')
+
+	if scheme.lower() != 'bearer' or not hmac.compare_digest(credentials.encode(), token.encode()):
+		return JSONResponse(content={'detail': 'Invalid admin token'}, status_code=401, headers={'WWW-Authenticate': 'Bearer'})
+
+	start_drain()
+
+	return JSONResponse(content={'draining': True}, status_code=202)
+
+
+@public_router.get("/health")
+async def endpoint_health():
+	status_code = 200 if readiness == ServerReadiness.READY else 503
+
+	return JSONResponse(content={'status': readiness.name}, status_code=status_code)
 
 
 @public_router.get("/")
 async def endpoint_index():
-	with open(r".\public\front\index.html") as f:
-		return HTMLResponse(content=f.read(), status_code=200)
+	content = await file_reader.read_text(os.path.join(FRONT_DIR, 'index.html'))
+	return HTMLResponse(content=content, status_code=200)
 	
 
 @public_router.get("/client.js")
 async def endpoint_client_js():
-	with open(r".\public\front\client.js") as f:
-		return HTMLResponse(content=f.read(), status_code=200, media_type="application/javascript")
+	content = await file_reader.read_text(os.path.join(FRONT_DIR, 'client.js'))
+	return HTMLResponse(content=content, status_code=200, media_type="application/javascript")
+
 
+@public_router.get("/metrics/websocket")
+async def endpoint_websocket_metrics():
+	return JSONResponse(content=manager.metrics.as_dict(), status_code=200)
 
-async def handle_track_download_request(websocket: WebSocket, ticket: int, username: str, filename: str):
+
+async def handle_track_download_request(client_id: str, track: TrackInfo):
+	'''
+	Runs as a task nobody awaits, its errors are logged here.
+	'''
+	try:
+		await download_track(client_id, track)
+
+	except Exception as e:
+		print(f"Download of {track.fullpath} from {track.username} for {client_id} failed: {e!r}")
+
+
+async def download_track(client_id: str, track: TrackInfo):
 	from aioslsk.transfer.model import TransferState
 
-	transfer = await slsk_start_track_transfer(slsk, ticket, username, filename)
-	
-	await manager.send_personal_message(f"Downloading {filename} from {username}...", websocket)
+	tracer = get_tracer()
 
-	# Wait for the transfer to finish
-	while not transfer.is_finalized():
-		await asyncio.sleep(5)
+	with tracer.start_as_current_span('track_download', attributes={'client_id': client_id, 'username': track.username, 'filename': track.fullpath}) as span:
+		transfer = None
 
-	if transfer.state == TransferState.FAILED:
-		await manager.send_personal_message(f"Download of {filename} from {username} failed!", websocket)
-		return
+		if track_prefetcher:
+			transfer = track_prefetcher.claim(track)
 
-	elif transfer.state == TransferState.ABORTED:
-		await manager.send_personal_message(f"Download of {filename} from {username} was cancelled!", websocket)
-		return
+		span.set_attribute('prefetched', transfer is not None)
+
+		if not transfer:
+			with tracer.start_as_current_span('slsk.download'):
+				transfer = await slsk_start_track_transfer(slsk, track.username, track.fullpath)
+		
+		msg = WebsocketServerMessage.from_track_download_response(track, TrackDownloadStatus.PENDING)
+		await manager.send_personal_message(msg.model_dump_json(), client_id)
+
+		# Wait for the transfer to finish, prefetched transfers may already be done
+		while not transfer.is_finalized():
+			await asyncio.sleep(5)
 
-	elif transfer.state == TransferState.COMPLETE:
-		await manager.send_personal_message(f"Download of {filename} from {username} finished!", websocket)
+		span.add_event('transfer_finalized', {'state': transfer.state.VALUE.name})
 
-		# Transfer transfer.local_path as binary
-		with open(transfer.local_path, 'rb') as f:
-			await websocket.send_bytes(f.read())
+		if transfer.state.VALUE in (TransferState.FAILED, TransferState.ABORTED):
+			msg = WebsocketServerMessage.from_track_download_response(track, TrackDownloadStatus.FAILED)
+			await manager.send_personal_message(msg.model_dump_json(), client_id)
+			return
 
-	# await manager.send_personal_message(f"Download of {filename} from {username} finished!", websocket)
+		elif transfer.state.VALUE == TransferState.COMPLETE:
+			msg = WebsocketServerMessage.from_track_download_response(track, TrackDownloadStatus.COMPLETED)
+			await manager.send_personal_message(msg.model_dump_json(), client_id)
+
+			# The client may have left or reconnected during the transfer, send to its current socket
+			websocket = manager.active_connections.get(client_id)
+
+			if websocket is None:
+				span.add_event('client_gone')
+				return
+
+			sent = 0
+
+			# Transfer transfer.local_path as binary, one frame per chunk
+			with tracer.start_as_current_span('send_file'):
+				async for chunk in file_reader.iter_chunks(transfer.local_path):
+					await websocket.send_bytes(chunk)
+					sent += len(chunk)
+
+			span.set_attribute('bytes_sent', sent)
+
+
+ClientMessageHandler = Callable[[WebSocket, str, WebsocketClientMessage], Awaitable[None]]
+
+client_message_handlers : dict[WebsocketClientMessageType, ClientMessageHandler] = {}
+
+active_downloads : dict[asyncio.Task, tuple[str, TrackInfo]] = {}
+
+
+def client_message_handler(msg_type: WebsocketClientMessageType):
+	def decorator(handler: ClientMessageHandler):
+		client_message_handlers[msg_type] = handler
+		return handler
+
+	return decorator
+
+
+@client_message_handler(WebsocketClientMessageType.SEARCH_REQUEST)
+async def on_search_request(websocket: WebSocket, client_id: str, msg: SearchRequestMessage):
+	await track_search_manager.register_search_request(client_id, msg.data.query)
+
+
+@client_message_handler(WebsocketClientMessageType.TRACK_DOWNLOAD_REQUEST)
+async def on_track_download_request(websocket: WebSocket, client_id: str, msg: TrackDownloadRequestMessage):
+	track = track_search_manager.find_track(msg.data.track_id)
+
+	if not track:
+		err = WebsocketServerMessage.from_bad_request(f"Unknown track: {msg.data.track_id}", fatal=False)
+		await manager.send_personal_message(err.model_dump_json(), client_id)
+		return
+
+	# Transfers take minutes, they must not hold the receive loop
+	task = asyncio.create_task(handle_track_download_request(client_id, track))
+	active_downloads[task] = (client_id, track)
+	task.add_done_callback(lambda t: active_downloads.pop(t, None))
 
 
 @public_router.websocket("/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str):
+	bucket = TokenBucket(
+		rate= config('WS_INBOUND_RATE', default=5, cast=float),
+		burst= config('WS_INBOUND_BURST', default=10, cast=int)
+	)
+
+	if readiness == ServerReadiness.DRAINING:
+		# Closing before accepting rejects the handshake with HTTP 403, clients would not see the reconnect hint
+		await websocket.accept()
+		await websocket.close(code=1012, reason="Server restarting, reconnect")
+		return
+
+	# One 429 per run of dropped messages, a flooding client must not get a reply per frame
+	rate_limited = False
+
 	try:
 		await manager.connect(client_id, websocket)
 
 		while True:
-			jsons = await websocket.receive_text()
-			msg = None
+			message = await websocket.receive()
+
+			if message['type'] == 'websocket.disconnect':
+				raise WebSocketDisconnect(message.get('code', 1000), message.get('reason'))
+
+			if not bucket.consume():
+				if not rate_limited:
+					rate_limited = True
+
+					err = WebsocketServerMessage.from_too_many_requests("Messages dropped, rate limit exceeded")
+					await manager.send_personal_message(err.model_dump_json(), client_id)
+
+				continue
+
+			rate_limited = False
+
+			jsons = message.get('text')
+
+			if jsons is None:
+				err = WebsocketServerMessage.from_bad_request("Binary messages are not supported", fatal=False)
+				await manager.send_personal_message(err.model_dump_json(), client_id)
+				continue
 
 			try:
 				msg = WebsocketClientMessage.from_json(jsons)
 
 			except Exception as e:
-				msg = WebsocketServerMessage.from_bad_request(f"Error parsing message: {e}")
+				err = WebsocketServerMessage.from_bad_request(f"Error parsing message: {e}")
 
-				await manager.send_personal_message(msg.model_dump_json(), websocket)
+				await manager.send_personal_message(err.model_dump_json(), client_id)
 
 				break
 
-			if msg.msg_type == WebsocketClientMessageType.SEARCH_REQUEST:
-				query = msg.struct_data.query
-
-				await track_search_manager.register_search_request(client_id, query)
+			if readiness != ServerReadiness.READY:
+				err = WebsocketServerMessage.from_unavailable(f"Server not ready: {readiness.name}")
+				await manager.send_personal_message(err.model_dump_json(), client_id)
+				continue
 
-			elif msg.msg_type == WebsocketClientMessage.TRACK_DOWNLOAD_REQUEST:
-				pass
+			await client_message_handlers[msg.msg_type](websocket, client_id, msg)
 
 	except WebSocketDisconnect:
-		await manager.disconnect(client_id)
\ No newline at end of file
+		pass
+
+	finally:
+		# Also on handler errors, or the client would stay subscribed to its searches
+		await manager.disconnect(client_id)
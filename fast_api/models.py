@@ -1,10 +1,10 @@
 from enum import Enum
-from json import loads
-from typing import Any, Iterable
-from pydantic import BaseModel
+from typing import TYPE_CHECKING, Annotated, Any, Iterable, Union
+from pydantic import BaseModel, Discriminator, Tag, TypeAdapter
 from nanoid import generate
 
-from aioslsk.search.model import FileData, SearchResult
+if TYPE_CHECKING:
+  from aioslsk.search.model import FileData, SearchResult
 
 def _generateid() -> str:
   return generate(size=8)
@@ -66,7 +66,7 @@ class TrackInfo(BaseModel):
     }
 
   @staticmethod
-  def from_file_data(file_data: FileData, username:str, ticket:int) -> 'TrackInfo':
+  def from_file_data(file_data: 'FileData', username:str, ticket:int) -> 'TrackInfo':
     filename = file_data.filename.split('\\')[-1]
 
     extension = file_data.extension
@@ -101,7 +101,7 @@ class TrackInfo(BaseModel):
     return hash((self.ticket, self.username, self.filename, self.fullpath, self.extension))
 
 
-def tracks_info_from_aiosk_search_results(s: SearchResult):
+def tracks_info_from_aiosk_search_results(s: 'SearchResult'):
   if not s.shared_items:
     return
 
@@ -140,21 +140,43 @@ class TrackDownloadRequest(BaseModel):
 
 class WebsocketClientMessage(BaseModel):
   msg_type: WebsocketClientMessageType
-  data: dict
+  data: SearchRequest|TrackDownloadRequest
 
   @staticmethod
-  def from_json(s:str) -> 'WebsocketClientMessage':
-    d = loads(s)
-
-    return WebsocketClientMessage(**d)
+  def from_json(s:str|bytes) -> 'WebsocketClientMessage':
+    '''
+    Parses and validates the message in a single pass, the `data` model is picked by `msg_type`.
+    '''
+    return _client_message_adapter.validate_json(s)
 
   @property
   def struct_data(self) -> SearchRequest|TrackDownloadRequest:
-    if self.msg_type == WebsocketClientMessageType.SEARCH_REQUEST:
-      return SearchRequest(**self.data)
+    return self.data
+
+
+class SearchRequestMessage(WebsocketClientMessage):
+  data: SearchRequest
+
+
+class TrackDownloadRequestMessage(WebsocketClientMessage):
+  data: TrackDownloadRequest
 
-    elif self.msg_type == WebsocketClientMessageType.TRACK_DOWNLOAD_REQUEST:
-      return TrackDownloadRequest(**self.data)
+
+def _client_message_tag(v: Any) -> str:
+  t = v.get('msg_type') if isinstance(v, dict) else getattr(v, 'msg_type', None)
+
+  return str(t.value if isinstance(t, Enum) else t)
+
+
+_client_message_adapter = TypeAdapter(
+  Annotated[
+    Union[
+      Annotated[SearchRequestMessage, Tag(str(WebsocketClientMessageType.SEARCH_REQUEST.value))],
+      Annotated[TrackDownloadRequestMessage, Tag(str(WebsocketClientMessageType.TRACK_DOWNLOAD_REQUEST.value))],
+    ],
+    Discriminator(_client_message_tag)
+  ]
+)
 
 
 # region Server
@@ -171,6 +193,18 @@ class WebsocketServerMessageType(Enum):
 
   ERROR = 4
 
+  # Soulseek session state, sent on connection and on every change
+  READINESS = 5
+
+
+class ServerReadiness(Enum):
+  STARTING = 1
+  '''Soulseek login in progress, searches and downloads are refused.'''
+  READY = 2
+  FAILED = 3
+  '''Soulseek login failed, it is retried in the background.'''
+  DRAINING = 4
+
 
 class SearchResponse(BaseModel):
   Id: str
@@ -180,6 +214,10 @@ class SearchResponse(BaseModel):
   current_results: int = 0
   resultset: set[TrackInfo]|None = None
 
+  chunk: int = 0
+  chunks: int = 1
+  '''A response over the payload size budget is split into `chunks` messages sharing the same Id.'''
+
 
 class TrackDownloadStatus(Enum):
   PENDING = 1
@@ -190,6 +228,8 @@ class TrackDownloadStatus(Enum):
 class WebsocketErrorCodes(Enum):
   INTERNAL = 500
   BAD_REQUEST = 400
+  TOO_MANY_REQUESTS = 429
+  UNAVAILABLE = 503
 
 
 class WsError(BaseModel):
@@ -213,12 +253,18 @@ class WebsocketServerMessage(BaseModel):
   Methods:
     from_internal_error(msg: str) -> 'WebsocketServerMessage':
       Creates a WebsocketServerMessage representing an internal error.
-    from_bad_request(msg: str) -> 'WebsocketServerMessage':
+    from_bad_request(msg: str, fatal: bool = True) -> 'WebsocketServerMessage':
       Creates a WebsocketServerMessage representing a bad request error.
+    from_too_many_requests(msg: str) -> 'WebsocketServerMessage':
+      Creates a WebsocketServerMessage representing a non-fatal rate limit error.
+    from_unavailable(msg: str) -> 'WebsocketServerMessage':
+      Creates a WebsocketServerMessage representing a non-fatal error of a request the server can not take right now.
     from_ws_server_message_enum() -> 'WebsocketServerMessage':
       Creates a WebsocketServerMessage containing all server message types.
-    from_search_response(query: str, ticket: int, total_results: int, resultset: Iterable[TrackInfo]|None = None) -> 'WebsocketServerMessage':
-      Creates a WebsocketServerMessage containing a search response.
+    from_readiness(readiness: ServerReadiness) -> 'WebsocketServerMessage':
+      Creates a WebsocketServerMessage containing the readiness state of the server.
+    from_search_response(query: str, ticket: int, total_results: int, resultset: Iterable[TrackInfo]|None = None, Id: str|None = None, chunk: int = 0, chunks: int = 1) -> 'WebsocketServerMessage':
+      Creates a WebsocketServerMessage containing a search response, or one chunk of it.
     from_track_info_list(track_info_list: list[TrackInfo]) -> 'WebsocketServerMessage':
       Creates a WebsocketServerMessage containing a list of track information.
     from_track_download_response(ticket: int, username: str, filename: str, status: TrackDownloadStatus) -> 'WebsocketServerMessage':
@@ -242,13 +288,37 @@ class WebsocketServerMessage(BaseModel):
       )
 
   @staticmethod
-  def from_bad_request(msg:str) -> 'WebsocketServerMessage':
+  def from_bad_request(msg:str, fatal:bool = True) -> 'WebsocketServerMessage':
     return WebsocketServerMessage (
       msg_type= WebsocketServerMessageType.ERROR,
 
       data= WsError(
         code= WebsocketErrorCodes.BAD_REQUEST,
-        fatal= True,
+        fatal= fatal,
+        msg= msg
+        )
+      )
+
+  @staticmethod
+  def from_too_many_requests(msg:str) -> 'WebsocketServerMessage':
+    return WebsocketServerMessage (
+      msg_type= WebsocketServerMessageType.ERROR,
+
+      data= WsError(
+        code= WebsocketErrorCodes.TOO_MANY_REQUESTS,
+        fatal= False,
+        msg= msg
+        )
+      )
+
+  @staticmethod
+  def from_unavailable(msg:str) -> 'WebsocketServerMessage':
+    return WebsocketServerMessage (
+      msg_type= WebsocketServerMessageType.ERROR,
+
+      data= WsError(
+        code= WebsocketErrorCodes.UNAVAILABLE,
+        fatal= False,
         msg= msg
         )
       )
@@ -260,22 +330,34 @@ class WebsocketServerMessage(BaseModel):
       data= { i.name: i.value for i in WebsocketServerMessageType }
       )
 
+  @staticmethod
+  def from_readiness(readiness: ServerReadiness) -> 'WebsocketServerMessage':
+    return WebsocketServerMessage (
+      msg_type= WebsocketServerMessageType.READINESS,
+      data= { 'state': readiness.name }
+      )
+
   @staticmethod
   def from_search_response( query: str, 
                             ticket: int,
                             total_results: int,
-                            resultset: Iterable[TrackInfo]|None = None) -> 'WebsocketServerMessage':
+                            resultset: Iterable[TrackInfo]|None = None,
+                            Id: str|None = None,
+                            chunk: int = 0,
+                            chunks: int = 1) -> 'WebsocketServerMessage':
     current_results = len(resultset) if resultset else 0
 
     return WebsocketServerMessage(
       msg_type= WebsocketServerMessageType.SEARCH_RESPONSE,
       data= SearchResponse(
-          Id= _generateid(),
+          Id= Id or _generateid(),
           query= query,
           ticket= ticket,
           resultset= resultset,
           total_results= total_results,
-          current_results= current_results
+          current_results= current_results,
+          chunk= chunk,
+          chunks= chunks
         )
     )
 
@@ -0,0 +1,171 @@
+import asyncio
+import os
+
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+from app.infra.slsk import slsk_start_track_transfer
+
+from .models import TrackInfo
+
+if TYPE_CHECKING:
+    from app.infra.slsk import SoulSeekClient, Transfer
+
+
+def track_quality_rank(track: TrackInfo) -> tuple|None:
+    '''
+    Sort key of the tracks worth prefetching, higher is better. Lossless files
+    rank above 320 kbps ones, anything else is not prefetched (None).
+    '''
+    extension = (track.extension or '').lower()
+
+    if extension == 'flac':
+        return (2, track.bit_depth or 0, track.sample_rate or 0)
+
+    if (track.bitrate or 0) >= 320:
+        return (1, track.bitrate, 0)
+
+    return None
+
+
+class TrackPrefetcher:
+    """
+    Speculatively downloads the best sources of a search so an eventual download
+    request is served from the local cache.
+    Attributes:
+        slsk (SoulSeekClient): The SoulSeek client used to start the transfers.
+        top_n (int): Sources prefetched per search.
+        disk_budget (int): Bytes of unclaimed prefetched files kept on disk.
+        max_transfers (int): Prefetch transfers allowed to run at the same time, the share of bandwidth left for them.
+    Methods:
+        prefetch(tracks: Iterable[TrackInfo]) -> int:
+            Ranks the tracks and starts the transfers of the best ones that fit in the budgets, returns how many were started.
+        saturated() -> bool:
+            Whether the running prefetch transfers use the whole transfer budget.
+        claim(track: TrackInfo) -> Transfer|None:
+            Hands over the prefetched transfer of the track, if any, and releases its budget.
+    """
+
+    def __init__(self, slsk: 'SoulSeekClient', top_n: int = 3, disk_budget: int = 2 * 1024 ** 3, max_transfers: int = 2):
+        self.slsk = slsk
+
+        self.top_n = top_n
+        self.disk_budget = disk_budget
+        self.max_transfers = max_transfers
+
+        self._transfers: OrderedDict[tuple[str, str], tuple[TrackInfo, 'Transfer']] = OrderedDict()
+        # Unclaimed prefetches indexed by (username, fullpath), oldest first
+
+        self._tasks: set[asyncio.Task] = set()
+
+    def _key(self, track: TrackInfo) -> tuple[str, str]:
+        return (track.username, track.fullpath)
+
+    def _used_disk(self) -> int:
+        return sum(track.filesize or 0 for track, _ in self._transfers.values())
+
+    def _running_transfers(self) -> int:
+        return sum(1 for _, transfer in self._transfers.values() if not transfer.is_finalized())
+
+    def saturated(self) -> bool:
+        return self._running_transfers() >= self.max_transfers
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    def _remove_files(paths: list[str]):
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _evict(self, needed: int) -> bool:
+        '''
+        Frees unclaimed, finished prefetches (oldest first) until `needed` bytes fit in the disk budget.
+        The budget is released right away, the files are removed in the thread pool.
+        '''
+        paths = []
+
+        for key, (track, transfer) in list(self._transfers.items()):
+            if self._used_disk() + needed <= self.disk_budget:
+                break
+
+            if not transfer.is_finalized():
+                continue
+
+            self._transfers.pop(key)
+
+            if transfer.local_path:
+                paths.append(transfer.local_path)
+
+        if paths:
+            self._spawn(asyncio.to_thread(self._remove_files, paths))
+
+        return self._used_disk() + needed <= self.disk_budget
+
+    def prefetch(self, tracks) -> int:
+        ranked = sorted(
+            (t for t in tracks if track_quality_rank(t) is not None),
+            key= track_quality_rank,
+            reverse= True
+        )
+
+        started = 0
+
+        for track in ranked[:self.top_n]:
+            if self._key(track) in self._transfers:
+                continue
+
+            if self.saturated():
+                break
+
+            if not self._evict(track.filesize or 0):
+                break
+
+            self._spawn(self._start(track))
+
+            # Reserve the budget while the transfer is being requested
+            self._transfers[self._key(track)] = (track, _PendingTransfer())
+
+            started += 1
+
+        return started
+
+    async def _start(self, track: TrackInfo):
+        try:
+            transfer = await slsk_start_track_transfer(self.slsk, track.username, track.fullpath)
+
+        except Exception:
+            self._transfers.pop(self._key(track), None)
+            return
+
+        # Claimed while the request was in flight
+        if self._key(track) not in self._transfers:
+            return
+
+        self._transfers[self._key(track)] = (track, transfer)
+
+    def claim(self, track: TrackInfo) -> 'Transfer|None':
+        from aioslsk.transfer.model import TransferState
+
+        _, transfer = self._transfers.pop(self._key(track), (None, None))
+
+        if isinstance(transfer, _PendingTransfer):
+            return None
+
+        # Failed prefetches are retried by the caller
+        if transfer and transfer.is_finalized() and transfer.state.VALUE != TransferState.COMPLETE:
+            return None
+
+        return transfer
+
+
+class _PendingTransfer:
+    '''Placeholder of a prefetch whose transfer has not been created yet.'''
+
+    local_path = None
+
+    def is_finalized(self) -> bool:
+        return False
@@ -1,109 +1,398 @@
+import asyncio
+
 from collections import namedtuple
+from enum import Enum
+from math import ceil
+from time import monotonic
+from typing import TYPE_CHECKING
 
 from app.infra.slsk import (
-    SoulSeekClient,
-    SearchResultEvent,
-    slsk_search_request
+    slsk_search_request,
+    slsk_remove_search_request
 )
 
+from app.infra.tracing import Span, get_tracer
 from app.infra.websockets import ConnectionManager
 
+from .track_prefetch import TrackPrefetcher
+
 from .models import (
     tracks_info_from_aiosk_search_results, 
     TrackInfo,
     WebsocketServerMessage
     )
 
+if TYPE_CHECKING:
+    from app.infra.slsk import SoulSeekClient, SearchResultEvent
+
 SearchIndex = namedtuple('SearchIndex', ['query', 'ticket'])
 
 
+class SearchState(Enum):
+    ACTIVE = 1
+    '''Results are accepted and delivered to subscribers.'''
+
+    DRAINING = 2
+    '''The result cap or max age was reached: upstream search is cancelled, incoming results are dropped, collected results are still served.'''
+
+    CLOSED = 3
+    '''The last subscriber left, the session is forgotten.'''
+
+
+class SearchSession:
+    def __init__(self, search_index: SearchIndex, span: Span):
+        self.search_index = search_index
+        self.state = SearchState.ACTIVE
+        self.started = monotonic()
+
+        self.span = span
+        '''Spans the whole lifecycle of the ticket, ended when the session closes.'''
+
+        self.first_result: float|None = None
+        self.first_delivery: float|None = None
+
+        self.trackset: set[TrackInfo] = set()
+        self.subscribers: set[str] = set()
+
+        self.stable_timer: asyncio.TimerHandle|None = None
+        self.prefetched = False
+
+        self.max_age_timer: asyncio.TimerHandle|None = None
+
+    def age(self) -> float:
+        return monotonic() - self.started
+
+
 class TrackSearchSessionManager:
     """
-    Manages track search sessions, handling search requests and broadcasting search results.
+    Manages track search sessions, handling search requests and delivering search results to the
+    clients subscribed to each search.
     Attributes:
         manager (ConnectionManager): The connection manager for handling websocket connections.
         slsk (SoulSeekClient): The SoulSeek client for performing search requests.
+        max_results (int): Results collected per ticket before the search starts draining, 0 means unlimited.
+        max_age (float): Seconds a search accepts results before it starts draining, 0 means unlimited.
+        prefetcher (TrackPrefetcher|None): Opt-in prefetch of the best sources once a search is stable.
+        stable_after (float): Seconds without new results after which a search is considered stable.
     Methods:
-        __init__(manager: ConnectionManager, slsk: SoulSeekClient):
+        __init__(manager: ConnectionManager, slsk: SoulSeekClient, max_results: int = 0, max_age: float = 0,
+                 prefetcher: TrackPrefetcher|None = None, stable_after: float = 5):
             Initializes the TrackSearchSessionManager with a connection manager and a SoulSeek client.
-        async register_search_request(query: str) -> tuple[str, int, set[TrackInfo]]:
-            Registers a search request, performs the search, and broadcasts the search response.
+        async register_search_request(client_id: str, query: str):
+            Subscribes the client to the search of the query, performing it if there is none, and sends the collected results.
+        find_track(track_id: str) -> TrackInfo|None:
+            Looks up a track of an open search by its Id.
+        async unsubscribe(client_id: str):
+            Removes the client from every search, closing the searches left without subscribers.
+        close_all():
+            Closes every search, used when the server drains.
+        snapshot() -> list[dict]:
+            Describes the open searches, to be saved when the server drains.
+        async resume_search(query: str, grace: float):
+            Restarts a search of a previous instance without subscribers, closing it if nobody subscribes within grace seconds.
         async on_search_result_event(e: SearchResultEvent):
-            Handles search result events, updates the track sets, and broadcasts new search results.
-        async broadcast_search_response(query: str, ticket: int, tracklist: list[TrackInfo]):
-            Broadcasts the search response to all connected clients.
+            Handles search result events, updates the track sets, and sends new search results to subscribers.
+        async broadcast_search_response(search_index: SearchIndex, tracklist: list[TrackInfo], client_id: str = ""):
+            Sends the search response to the subscribers of the search, or to client_id, split in chunks
+            when it exceeds the connection manager payload size budget.
     """
 
-    _tracksets: dict[SearchIndex, set[TrackInfo]] = {}
-    # Variable that stores a map of track sets indexed by SearchIndex
+    _sessions: dict[int, SearchSession]
+    # Variable that stores the open search sessions indexed by ticket
 
     manager: ConnectionManager
-    slsk: SoulSeekClient
+    slsk: 'SoulSeekClient'
 
-    def __init__(self, manager: ConnectionManager, slsk: SoulSeekClient):
+    def __init__(self, manager: ConnectionManager, slsk: 'SoulSeekClient', max_results: int = 0, max_age: float = 0,
+                 prefetcher: TrackPrefetcher|None = None, stable_after: float = 5):
         self.manager = manager
         self.slsk = slsk
 
+        self.max_results = max_results
+        self.max_age = max_age
+
+        self.prefetcher = prefetcher
+        self.stable_after = stable_after
+
+        self._sessions = {}
+
     def _trackset_by_search(self, search_index: SearchIndex):
-        return self._tracksets.get(search_index, set())
+        session = self._sessions.get(search_index.ticket)
 
-    def _remove_trackset(self, search_index: SearchIndex):
-        self._tracksets.pop(search_index, None)
+        return session.trackset if session else set()
 
-    async def register_search_request(self, client_id:str, query: str) -> tuple[str, int, set[TrackInfo]]:
-        for search_index, tracklist in self._tracksets.items():
-            if search_index.query != query:
-                continue
+    def _session_by_query(self, query: str) -> SearchSession|None:
+        # Draining sessions keep serving their subscribers, new searchers get a fresh search
+        for session in self._sessions.values():
+            if session.search_index.query == query and session.state == SearchState.ACTIVE:
+                return session
+
+    def find_track(self, track_id: str) -> TrackInfo|None:
+        for session in self._sessions.values():
+            for track in session.trackset:
+                if track.Id == track_id:
+                    return track
+
+    def _on_stable(self, session: SearchSession):
+        session.stable_timer = None
+
+        if not self.prefetcher or session.prefetched or session.state == SearchState.CLOSED:
+            return
 
-            await self.broadcast_search_response(query, search_index.ticket, tracklist, client_id= client_id)
+        if self.prefetcher.prefetch(session.trackset):
+            session.prefetched = True
+
+        # Saturated by other searches: retry later instead of giving up on this one
+        elif self.prefetcher.saturated():
+            session.stable_timer = asyncio.get_running_loop().call_later(self.stable_after, self._on_stable, session)
+
+    def _reset_stable_timer(self, session: SearchSession):
+        if not self.prefetcher:
+            return
+
+        if session.stable_timer:
+            session.stable_timer.cancel()
+
+        session.stable_timer = asyncio.get_running_loop().call_later(self.stable_after, self._on_stable, session)
+
+    def _on_max_age(self, session: SearchSession):
+        session.max_age_timer = None
+
+        self._drain(session)
+
+    def _drain(self, session: SearchSession, prefetch: bool = True):
+        if session.state != SearchState.ACTIVE:
             return
 
-        search_request = await slsk_search_request(self.slsk, query)
+        session.state = SearchState.DRAINING
+        slsk_remove_search_request(self.slsk, session.search_index.ticket)
+
+        if session.max_age_timer:
+            session.max_age_timer.cancel()
+
+        session.span.set_attribute('time_to_complete_ms', session.age() * 1000)
+        session.span.set_attribute('results', len(session.trackset))
+
+        if session.stable_timer:
+            session.stable_timer.cancel()
+
+        # No more results will come, the search is as stable as it gets
+        if prefetch and session.subscribers:
+            self._on_stable(session)
+
+    def _close(self, session: SearchSession):
+        # Closing searches, on server drain too, must not start speculative downloads
+        self._drain(session, prefetch= False)
+
+        if session.stable_timer:
+            session.stable_timer.cancel()
+
+        session.state = SearchState.CLOSED
+        self._sessions.pop(session.search_index.ticket, None)
+
+        session.span.end()
+
+    async def register_search_request(self, client_id:str, query: str):
+        tracer = get_tracer()
+
+        with tracer.start_as_current_span('register_search_request', attributes={'client_id': client_id, 'query': query}) as span:
+            session = self._session_by_query(query)
+
+            if session:
+                span.set_attribute('ticket', session.search_index.ticket)
+                span.set_attribute('cached', True)
+
+                session.subscribers.add(client_id)
+
+                await self.broadcast_search_response(session.search_index, session.trackset, client_id= client_id)
+                return
+
+            session = await self._start_search(query)
+            session.subscribers.add(client_id)
+
+            span.set_attribute('ticket', session.search_index.ticket)
+            span.set_attribute('cached', False)
+
+            await self.broadcast_search_response(session.search_index, session.trackset, client_id= client_id)
+
+    async def _start_search(self, query: str) -> SearchSession:
+        tracer = get_tracer()
+
+        with tracer.start_as_current_span('slsk.search'):
+            search_request = await slsk_search_request(self.slsk, query)
 
         search_index = SearchIndex(query=search_request.query, ticket=search_request.ticket)
 
-        s = self._tracksets.setdefault(search_index, set())
+        search_span = tracer.start_span('search', attributes={'query': query, 'ticket': search_index.ticket})
+
+        session = self._sessions[search_index.ticket] = SearchSession(search_index, search_span)
+
+        # Searches whose results stop coming must drain too, not only the ones still receiving results
+        if self.max_age:
+            session.max_age_timer = asyncio.get_running_loop().call_later(self.max_age, self._on_max_age, session)
+
+        return session
 
-        await self.broadcast_search_response(search_index, s, client_id= client_id)
+    def _close_if_unsubscribed(self, session: SearchSession):
+        if session.state != SearchState.CLOSED and not session.subscribers:
+            self._close(session)
+
+    async def resume_search(self, query: str, grace: float):
+        if self._session_by_query(query):
+            return
+
+        session = await self._start_search(query)
+
+        # Clients reconnecting after a restart search again and subscribe to it
+        asyncio.get_running_loop().call_later(grace, self._close_if_unsubscribed, session)
+
+    async def unsubscribe(self, client_id: str):
+        for session in list(self._sessions.values()):
+            # Sessions without subscribers of their own, like resumed ones, are left alone
+            if client_id not in session.subscribers:
+                continue
 
-    async def on_search_result_event(self, e: SearchResultEvent):
-        search_index = SearchIndex(query=e.query.query, ticket=e.query.ticket)
+            session.subscribers.discard(client_id)
 
-        self._tracksets.setdefault(search_index, set())
+            if not session.subscribers:
+                self._close(session)
 
-        newtracks = []
+    def close_all(self):
+        for session in list(self._sessions.values()):
+            self._close(session)
 
-        for r in e.query.results:
-            for tt in tracks_info_from_aiosk_search_results(r):
-                if not tt or tt in self._trackset_by_search(search_index):
+    def snapshot(self) -> list[dict]:
+        return [
+            {
+                'query': session.search_index.query,
+                'ticket': session.search_index.ticket,
+                'state': session.state.name,
+                'age': session.age(),
+                'results': len(session.trackset),
+                'subscribers': sorted(session.subscribers),
+            }
+            for session in self._sessions.values()
+        ]
+
+    async def on_search_result_event(self, e: 'SearchResultEvent'):
+        session = self._sessions.get(e.query.ticket)
+
+        # Drop results of closed, draining or foreign searches before parsing them
+        if not session or session.state != SearchState.ACTIVE:
+            return
+
+        search_index = session.search_index
+
+        if session.first_result is None:
+            session.first_result = session.age()
+            session.span.set_attribute('time_to_first_result_ms', session.first_result * 1000)
+
+        with get_tracer().start_as_current_span('on_search_result_event', attributes={'ticket': search_index.ticket, 'username': e.result.username}) as span:
+            newtracks = []
+
+            for tt in tracks_info_from_aiosk_search_results(e.result):
+                if not tt or tt in session.trackset:
                     continue
 
-                self._trackset_by_search(search_index).add(tt)
+                if self.max_results and len(session.trackset) >= self.max_results:
+                    self._drain(session)
+                    break
+
+                session.trackset.add(tt)
 
                 newtracks.append(tt)
 
-        if not newtracks:
-            return
+            span.set_attribute('new_tracks', len(newtracks))
+
+            if not newtracks:
+                return
+
+            if session.state == SearchState.ACTIVE:
+                self._reset_stable_timer(session)
 
-        await self.broadcast_search_response(search_index, newtracks)
+            await self.broadcast_search_response(search_index, newtracks)
+
+    def _search_response_payloads(self,
+                                  search_index: SearchIndex,
+                                  tracklist: list[TrackInfo]
+                                  ) -> list[tuple[str, int]]:
+        '''
+        Serializes the search response in as few chunks as fit in the payload size budget.
+        Returns the payloads with their encoded sizes.
+        '''
+        total_results = len(self._trackset_by_search(search_index))
+        budget = self.manager.max_payload_size
+
+        tracklist = list(tracklist)
+        msg_id = None
+
+        def serialize(parts: list[list[TrackInfo]]) -> list[tuple[str, int]]:
+            nonlocal msg_id
+
+            payloads = []
+
+            for n, part in enumerate(parts):
+                msg = WebsocketServerMessage.from_search_response(
+                    query=  search_index.query,
+                    ticket= search_index.ticket,
+                    total_results=  total_results,
+                    resultset=  part,
+                    Id= msg_id,
+                    chunk= n,
+                    chunks= len(parts)
+                    )
+
+                msg_id = msg.data.Id
+
+                s = msg.model_dump_json()
+                payloads.append((s, len(s.encode())))
+
+            return payloads
+
+        payloads = serialize([tracklist])
+
+        if not budget or len(tracklist) <= 1 or payloads[0][1] <= budget:
+            return payloads
+
+        # Estimate the chunk count from the full payload, with some slack for uneven track sizes
+        overhead = serialize([[]])[0][1]
+        chunks = ceil((payloads[0][1] - overhead) / max((budget - overhead) * 0.9, 1))
+
+        while True:
+            size = ceil(len(tracklist) / chunks)
+            payloads = serialize([tracklist[i:i + size] for i in range(0, len(tracklist), size)])
+
+            # Rare: the estimate fell short, retry with smaller chunks
+            if size == 1 or all(n <= budget for _, n in payloads):
+                return payloads
+
+            chunks = max(chunks + 1, ceil(chunks * 1.5))
 
     async def broadcast_search_response(self, 
                                         search_index: SearchIndex,
                                         tracklist: list[TrackInfo],
                                         client_id: str = ""
                                         ):
-        total_results = len(self._trackset_by_search(search_index))
-
-        msg = WebsocketServerMessage.from_search_response(
-            query=  search_index.query,
-            ticket= search_index.ticket,
-            total_results=  total_results,
-            resultset=  tracklist
-            )
-        
-        s = msg.model_dump_json()
+        session = self._sessions.get(search_index.ticket)
 
         if client_id:
-            await self.manager.send_personal_message(s, client_id= client_id)
+            client_ids = [client_id]
         else:
-            await self.manager.broadcast(s)
+            client_ids = list(session.subscribers) if session else []
+
+        if not client_ids:
+            return
+
+        with get_tracer().start_as_current_span('broadcast_search_response', attributes={'ticket': search_index.ticket, 'recipients': len(client_ids)}) as span:
+            payloads = self._search_response_payloads(search_index, tracklist)
+
+            span.set_attribute('results', len(tracklist))
+            span.set_attribute('chunks', len(payloads))
+
+            # Chunks in order, each one to every subscriber at once
+            for s, size in payloads:
+                await self.manager.send_many(s, client_ids, size= size)
+
+        if session and tracklist and session.first_delivery is None:
+            session.first_delivery = session.age()
+            session.span.set_attribute('time_to_first_delivery_ms', session.first_delivery * 1000)
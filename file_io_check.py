@@ -0,0 +1,112 @@
+'''
+Event loop lag check of the non-blocking file reader (app/infra/files.py).
+
+Writes a temporary file of --size_mb, streams it with `AsyncFileReader.iter_chunks`
+the way finished transfers are sent to clients, and measures meanwhile how late
+the event loop wakes up a periodic timer. Exits with status 1 when the worst lag
+exceeds --max_lag_ms.
+
+	python file_io_check.py --size_mb 200 --max_lag_ms 50
+
+With --baseline the same file is also read with a blocking `f.read()` on the
+event loop, to show the lag the reader avoids.
+'''
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+from app.infra.files import AsyncFileReader
+
+
+async def _monitor_lag(interval: float, lags_ms: list[float], stop: asyncio.Event):
+	while not stop.is_set():
+		started = time.monotonic()
+		await asyncio.sleep(interval)
+		lags_ms.append((time.monotonic() - started - interval) * 1000)
+
+
+async def _measure(read, interval: float) -> dict:
+	lags_ms: list[float] = []
+	stop = asyncio.Event()
+
+	monitor = asyncio.create_task(_monitor_lag(interval, lags_ms, stop))
+
+	# Let the monitor take a first sample before the reads start
+	await asyncio.sleep(interval)
+
+	started = time.monotonic()
+	size = await read()
+	elapsed = time.monotonic() - started
+
+	stop.set()
+	await monitor
+
+	return {
+		'bytes': size,
+		'seconds': round(elapsed, 3),
+		'lag_max_ms': round(max(lags_ms), 2),
+		'lag_mean_ms': round(sum(lags_ms) / len(lags_ms), 2),
+	}
+
+
+async def run(args) -> dict:
+	reader = AsyncFileReader(chunk_size= args.chunk_size)
+
+	fd, path = tempfile.mkstemp(suffix='.bin')
+
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			chunk = os.urandom(1024 * 1024)
+
+			for _ in range(args.size_mb):
+				f.write(chunk)
+
+		async def read_chunks() -> int:
+			size = 0
+
+			async for chunk in reader.iter_chunks(path):
+				size += len(chunk)
+				# Yield like a websocket send would
+				await asyncio.sleep(0)
+
+			return size
+
+		async def read_blocking() -> int:
+			with open(path, 'rb') as f:
+				return len(f.read())
+
+		report = { 'iter_chunks': await _measure(read_chunks, args.interval) }
+
+		if args.baseline:
+			report['blocking_read'] = await _measure(read_blocking, args.interval)
+
+	finally:
+		os.remove(path)
+
+	report['max_lag_ms'] = args.max_lag_ms
+	report['passed'] = report['iter_chunks']['lag_max_ms'] <= args.max_lag_ms
+
+	return report
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(description= 'Comprobar que la lectura de archivos no bloquea el event loop')
+
+	parser.add_argument('--size_mb', type=int, help='Tamano del archivo de prueba en MB', default=200)
+	parser.add_argument('--chunk_size', type=int, help='Tamano de cada lectura en bytes', default=1024 * 1024)
+	parser.add_argument('--interval', type=float, help='Periodo del temporizador que mide el retraso, en segundos', default=0.01)
+	parser.add_argument('--max_lag_ms', type=float, help='Retraso maximo aceptado del event loop en ms', default=50)
+	parser.add_argument('--baseline', action='store_true', help='Medir tambien una lectura bloqueante')
+
+	args = parser.parse_args()
+
+	report = asyncio.run(run(args))
+
+	print(json.dumps(report, indent=2))
+
+	sys.exit(0 if report['passed'] else 1)
@@ -0,0 +1,281 @@
+'''
+Load test of `api:app` against the synthetic Soulseek backend (app/infra/fake_slsk.py).
+
+Starts the API in a subprocess with SLSK_BACKEND=fake, connects a swarm of
+websocket clients, sends one search per client and reports result delivery
+latency (p50/p99), received messages per second and the server RSS.
+
+	python loadtest.py --clients 200 --duration 20
+
+With --startup it measures instead the time until the server listens and until
+/health reports ready, with and without SLSK_DEFERRED_LOGIN.
+
+	python loadtest.py --startup --login_seconds 2
+'''
+import asyncio
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+import websockets
+
+_TIMESTAMP_RE = re.compile(r'\[(\d+)\]\.\w+$')
+
+SEARCH_REQUEST = 1
+SEARCH_RESPONSE = 2
+
+
+def _free_port() -> int:
+	with socket.socket() as s:
+		s.bind(('127.0.0.1', 0))
+		return s.getsockname()[1]
+
+
+def _rss_bytes(pid: int) -> int|None:
+	try:
+		with open(f'/proc/{pid}/status') as f:
+			for line in f:
+				if line.startswith('VmRSS:'):
+					return int(line.split()[1]) * 1024
+
+	except OSError:
+		return None
+
+
+def _percentile(values: list[float], p: float) -> float|None:
+	if not values:
+		return None
+
+	if len(values) == 1:
+		return values[0]
+
+	return statistics.quantiles(values, n=100, method='inclusive')[int(p) - 1]
+
+
+async def _wait_for_port(host: str, port: int, timeout: float):
+	deadline = time.monotonic() + timeout
+
+	while time.monotonic() < deadline:
+		try:
+			_, writer = await asyncio.open_connection(host, port)
+			writer.close()
+			return
+
+		except OSError:
+			await asyncio.sleep(0.1)
+
+	raise TimeoutError(f'server did not listen on {host}:{port} after {timeout}s')
+
+
+class Stats:
+	def __init__(self):
+		self.messages = 0
+		self.bytes = 0
+		self.results = 0
+		self.latencies_ms: list[float] = []
+		self.errors = 0
+
+
+async def _client(url: str, query: str, stats: Stats, stop: asyncio.Event):
+	try:
+		async with websockets.connect(url, max_size=None) as ws:
+			await ws.send(json.dumps({ 'msg_type': SEARCH_REQUEST, 'data': { 'query': query } }))
+
+			while not stop.is_set():
+				try:
+					raw = await asyncio.wait_for(ws.recv(), timeout=0.5)
+				except asyncio.TimeoutError:
+					continue
+
+				received_ns = time.time_ns()
+
+				stats.messages += 1
+				stats.bytes += len(raw)
+
+				if isinstance(raw, bytes):
+					continue
+
+				msg = json.loads(raw)
+
+				if msg.get('msg_type') != SEARCH_RESPONSE:
+					continue
+
+				for track in msg['data'].get('resultset') or []:
+					stats.results += 1
+
+					m = _TIMESTAMP_RE.search(track['fullpath'])
+
+					if m:
+						stats.latencies_ms.append((received_ns - int(m.group(1))) / 1e6)
+
+	except Exception:
+		stats.errors += 1
+
+
+async def _sample_rss(pid: int, samples: list[int], stop: asyncio.Event):
+	while not stop.is_set():
+		rss = _rss_bytes(pid)
+
+		if rss is not None:
+			samples.append(rss)
+
+		await asyncio.sleep(0.5)
+
+
+def _health_ready(port: int) -> bool:
+	try:
+		with urllib.request.urlopen(f'http://127.0.0.1:{port}/health', timeout=1) as r:
+			return r.status == 200
+
+	except (urllib.error.URLError, OSError):
+		return False
+
+
+async def _startup_round(args, deferred: bool) -> dict:
+	port = _free_port()
+
+	env = {
+		**os.environ,
+		'SLSK_BACKEND': 'fake',
+		'SLSK_DEFERRED_LOGIN': str(deferred),
+		'FAKE_SLSK_LOGIN_SECONDS': str(args.login_seconds),
+	}
+
+	started = time.monotonic()
+
+	server = subprocess.Popen(
+		[sys.executable, 'api.py', '--host', '127.0.0.1', '--port', str(port)],
+		cwd= os.path.dirname(os.path.abspath(__file__)),
+		env= env,
+		stdout= subprocess.DEVNULL,
+		stderr= None if args.verbose else subprocess.DEVNULL
+		)
+
+	try:
+		await _wait_for_port('127.0.0.1', port, timeout=60)
+		listening = time.monotonic() - started
+
+		while not await asyncio.to_thread(_health_ready, port):
+			await asyncio.sleep(0.02)
+
+		ready = time.monotonic() - started
+
+	finally:
+		server.terminate()
+		server.wait(timeout=10)
+
+	return { 'listening_s': listening, 'ready_s': ready }
+
+
+async def run_startup(args) -> dict:
+	report = {}
+
+	for deferred in (False, True):
+		rounds = [ await _startup_round(args, deferred) for _ in range(args.rounds) ]
+
+		report['deferred_login' if deferred else 'eager_login'] = {
+			'listening_s': round(statistics.median(r['listening_s'] for r in rounds), 3),
+			'ready_s': round(statistics.median(r['ready_s'] for r in rounds), 3),
+		}
+
+	report['login_seconds'] = args.login_seconds
+	report['rounds'] = args.rounds
+
+	return report
+
+
+async def run(args) -> dict:
+	port = args.port or _free_port()
+
+	env = {
+		**os.environ,
+		'SLSK_BACKEND': 'fake',
+		'FAKE_SLSK_PEERS': str(args.peers),
+		'FAKE_SLSK_FILES_PER_PEER': str(args.files_per_peer),
+		'FAKE_SLSK_RESULTS_PER_SECOND': str(args.rate),
+	}
+
+	server = subprocess.Popen(
+		[sys.executable, 'api.py', '--host', '127.0.0.1', '--port', str(port)],
+		cwd= os.path.dirname(os.path.abspath(__file__)),
+		env= env,
+		stdout= subprocess.DEVNULL,
+		stderr= None if args.verbose else subprocess.DEVNULL
+		)
+
+	try:
+		await _wait_for_port('127.0.0.1', port, timeout=30)
+
+		stats = Stats()
+		rss_samples: list[int] = []
+		stop = asyncio.Event()
+
+		sampler = asyncio.create_task(_sample_rss(server.pid, rss_samples, stop))
+
+		started = time.monotonic()
+
+		clients = [
+			asyncio.create_task(_client(
+				f'ws://127.0.0.1:{port}/bench{i}',
+				f'bench {i % args.queries}',
+				stats,
+				stop
+				))
+			for i in range(args.clients)
+		]
+
+		await asyncio.sleep(args.duration)
+		stop.set()
+
+		elapsed = time.monotonic() - started
+
+		await asyncio.gather(*clients, sampler)
+
+	finally:
+		server.terminate()
+		server.wait(timeout=10)
+
+	return {
+		'clients': args.clients,
+		'duration_s': round(elapsed, 2),
+		'client_errors': stats.errors,
+		'messages': stats.messages,
+		'messages_per_s': round(stats.messages / elapsed, 1),
+		'bytes_received': stats.bytes,
+		'results_received': stats.results,
+		'latency_p50_ms': _percentile(stats.latencies_ms, 50),
+		'latency_p99_ms': _percentile(stats.latencies_ms, 99),
+		'rss_peak_bytes': max(rss_samples) if rss_samples else None,
+	}
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(description= 'Prueba de carga de la API con un backend Soulseek simulado')
+
+	parser.add_argument('--clients', type=int, help='Clientes websocket concurrentes', default=200)
+	parser.add_argument('--queries', type=int, help='Busquedas distintas repartidas entre los clientes', default=200)
+	parser.add_argument('--duration', type=float, help='Duracion de la prueba en segundos', default=20)
+
+	parser.add_argument('--peers', type=int, help='Peers simulados por busqueda', default=20)
+	parser.add_argument('--files_per_peer', type=int, help='Archivos por peer simulado', default=10)
+	parser.add_argument('--rate', type=float, help='Resultados por segundo por busqueda', default=50)
+
+	parser.add_argument('--startup', action='store_true', help='Medir el tiempo de arranque en lugar de la carga')
+	parser.add_argument('--login_seconds', type=float, help='Duracion simulada del login a Soulseek (--startup)', default=2)
+	parser.add_argument('--rounds', type=int, help='Arranques por modo, se reporta la mediana (--startup)', default=3)
+
+	parser.add_argument('--port', type=int, help='Puerto del servidor (libre por defecto)', default=None)
+	parser.add_argument('--verbose', action='store_true', help='Mostrar el log del servidor')
+
+	args = parser.parse_args()
+
+	print(json.dumps(asyncio.run(run_startup(args) if args.startup else run(args)), indent=2))
@@ -124,14 +124,18 @@ class SearchResponse {
   * @param {int} total_results 
   * @param {int} current_results 
   * @param {Array<TrackInfo>} resultset
+  * @param {int} chunk
+  * @param {int} chunks
   */
-  constructor(Id, query, ticket, total_results, current_results, resultset) {
+  constructor(Id, query, ticket, total_results, current_results, resultset, chunk = 0, chunks = 1) {
     this.Id = Id;
     this.query = query;
     this.ticket = ticket;
     this.total_results = total_results;
     this.current_results = current_results;
     this.resultset = resultset;
+    this.chunk = chunk;
+    this.chunks = chunks;
   }
 
   static fromJson(d) {
@@ -141,7 +145,9 @@ class SearchResponse {
       d.ticket,
       d.total_results,
       d.current_results,
-      d.resultset.map((trackInfo) => TrackInfo.fromJson(trackInfo))
+      d.resultset.map((trackInfo) => TrackInfo.fromJson(trackInfo)),
+      d.chunk,
+      d.chunks
     );
   }
 }
@@ -199,7 +205,8 @@ class SlskWebSocketClient {
       searchResponse: [],
       trackInfo: [],
       trackDownloadResponse: [],
-      slskError: []
+      slskError: [],
+      readiness: []
     };
   }
   
@@ -213,7 +220,8 @@ class SlskWebSocketClient {
     TRACK_INFO: 1,
     SEARCH_RESPONSE: 2,
     TRACK_DOWNLOAD_RESPONSE: 3,  
-    ERROR: 4
+    ERROR: 4,
+    READINESS: 5
   };
   
   connect() {
@@ -282,6 +290,10 @@ class SlskWebSocketClient {
 
         this._triggerEvent('slskError', wserror);
       }
+
+      else if (data.msg_type === SlskWebSocketClient.ServerMessageTypes.READINESS) {
+        this._triggerEvent('readiness', data.data.state);
+      }
     }
 
     catch (e) {
@@ -317,6 +329,10 @@ class SlskWebSocketClient {
     this.on('slskError', handler);
   }
 
+  onReadiness(handler) {
+    this.on('readiness', handler);
+  }
+
   _triggerEvent(event, data) {
     if (this.eventHandlers[event]) {
       this.eventHandlers[event].forEach((handler) => handler(data));